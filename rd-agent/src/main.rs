@@ -953,7 +953,7 @@ impl Config {
         }
 
         // support binaries for iocost_coef_gen.py
-        for dep in &["findmnt", "dd", "fio", "stdbuf"] {
+        for dep in &["fio"] {
             if find_bin(dep, Option::<&str>::None).is_none() {
                 self.sr_failed.add(
                     SysReq::DepsIoCostCoefGen,
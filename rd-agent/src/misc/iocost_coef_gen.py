@@ -26,20 +26,27 @@ for more details.
 """
 
 import argparse
-import re
+import bisect
+import dataclasses
 import json
 import glob
+import fcntl
+import functools
+import mmap
 import os
 import sys
-import math
 import time
 import signal
 import atexit
 import random
-import shutil
 import tempfile
 import subprocess
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 parser = argparse.ArgumentParser(description=desc,
                                  formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument('--testdev', metavar='DEV',
@@ -58,35 +65,77 @@ parser.add_argument('--rand-depth', type=int, metavar='DEPTH', default=256,
                     help='Random test queue depth (default: %(default)s)')
 parser.add_argument('--numjobs', type=int, metavar='JOBS', default=8,
                     help='Number of parallel fio jobs to run on SSD (default: %(default)s)')
+parser.add_argument('--ioengine', choices=['libaio', 'io_uring'], default='libaio',
+                    help='fio IO engine to use (default: %(default)s)')
 parser.add_argument('--json', metavar='FILE',
                     help='Store the results to the specified json file')
 parser.add_argument('--model-override', metavar='"rbps=XXX rseqiops=XXX..."',
                     help='Use the specified model params instead of testing for them')
 parser.add_argument('--qos-override', metavar='"rpct=XXX rlat=XXX wpct=XXX wlat=XXX min=XXX max=XXX"',
                     help='Use the specified QoS params instead of testing for them')
+parser.add_argument('--parallel-probes', action='store_true',
+                    help='Run the read and write model probes concurrently on SSDs')
+parser.add_argument('--fused-qos', action='store_true',
+                    help='Determine read and write QoS params from a single mixed run')
 parser.add_argument('--quiet', action='store_true')
 parser.add_argument('--verbose', action='store_true')
 
+# Everything the helpers need to know about the current run. Passed around
+# explicitly instead of living in module globals.
+@dataclasses.dataclass(eq=False)
+class Cfg:
+    args: argparse.Namespace
+    dev_path: str = None
+    elevator_path: str = None
+    nomerges_path: str = None
+    elevator: str = None
+    nomerges: str = None
+    target_size: int = 0
+
 def err(msg):
     print(msg, file=sys.stderr)
     sys.stderr.flush()
 
-def info(msg):
-    if not args.quiet:
+def info(cfg, msg):
+    if not cfg.args.quiet:
         print(msg, file=sys.stderr)
         sys.stderr.flush()
 
-def dbg(msg):
+def dbg(cfg, msg):
+    args = cfg.args
     if args.verbose and not args.quiet:
         print(msg, file=sys.stderr)
         sys.stderr.flush()
 
 # determine ('DEVNAME', 'MAJ:MIN') for @path
-def dir_to_dev(path):
-    # find the block device the current directory is on
-    devname = subprocess.run(f'findmnt -nvo SOURCE -T{path}',
-                             stdout=subprocess.PIPE, shell=True).stdout;
-    devname = devname.decode('utf-8').strip();
+def dir_to_dev(cfg, path):
+    # find the block device the current directory is on by matching its
+    # st_dev against the MAJ:MIN field of /proc/self/mountinfo. If that
+    # fails (e.g. btrfs subvolumes), use the mount with the longest mount
+    # point which contains @path.
+    st_dev = os.stat(path).st_dev
+    devnr = f'{os.major(st_dev)}:{os.minor(st_dev)}'
+    realpath = os.path.realpath(path)
+    devname = None
+    best_mnt = None
+    with open('/proc/self/mountinfo', 'r') as f:
+        for line in f:
+            toks = line.split()
+            # optional fields are terminated by '-', followed by fstype and source
+            source = toks[toks.index('-', 6) + 2]
+            if toks[2] == devnr:
+                devname = source
+                break
+            mnt = toks[4]
+            if ((realpath == mnt or realpath.startswith(mnt.rstrip('/') + '/')) and
+                (best_mnt is None or len(mnt) >= len(best_mnt))):
+                best_mnt = mnt
+                best_source = source
+    if devname is None and best_mnt is not None:
+        devname = best_source
+    if not devname or not devname.startswith('/'):
+        err(f'Failed to find the block device for {realpath}, use --testfile-dev')
+        sys.exit(1)
     while os.path.islink(devname):
         link = os.readlink(devname)
         if not os.path.isabs(link):
@@ -94,87 +143,221 @@ def dir_to_dev(path):
         devname = os.path.realpath(link)
 
     if devname.startswith("/dev/dm") or devname.startswith("/dev/md"):
-        info(f'{devname} is composite, you probably want to use --testfile-dev to specify the underlying device')
+        info(cfg, f'{devname} is composite, you probably want to use --testfile-dev to specify the underlying device')
 
     devname = os.path.basename(devname)
 
+    if not os.path.exists(f'/sys/class/block/{devname}'):
+        err(f'{devname} for {realpath} is not a block device, use --testfile-dev')
+        sys.exit(1)
+
     # partition -> whole device
     parents = glob.glob('/sys/block/*/' + devname)
     if len(parents):
         devname = os.path.basename(os.path.dirname(parents[0]))
     return devname
 
-def create_testfile(path, size):
-    global args
-
+def create_testfile(cfg, path, size):
     if os.path.isfile(path) and os.stat(path).st_size == size:
         return
 
-    subprocess.check_call(f'rm -f {path}', shell=True)
-    subprocess.check_call(f'touch {path}', shell=True)
-    subprocess.call(f'chattr +C {path}', shell=True)
-    cmd = (f'dd if=/dev/urandom of={path} count={size} '
-           f'iflag=count_bytes,fullblock oflag=direct bs=16M status=none')
-    p = subprocess.Popen(cmd, shell=True)
-    while p.poll() == None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    open(path, 'ab').close()
+    try:
+        subprocess.call(['chattr', '+C', path])
+    except OSError:
+        pass
+
+    # Reads from unwritten extents never reach the device, so the whole
+    # file must actually be written - fallocate won't do. The contents only
+    # need to be incompressible, so keep repeating a single random buffer
+    # instead of draining /dev/urandom. mmap gives the page alignment
+    # O_DIRECT requires.
+    chunk = 16 << 20
+    buf = mmap.mmap(-1, chunk)
+    buf.write(os.urandom(chunk))
+    buf = memoryview(buf)
+
+    info(cfg, f'Creating {size/(1<<30):.2f}G testfile')
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_DIRECT)
         try:
-            cur = os.stat(path).st_size
-            info(f'Creating {size/(1<<30):.2f}G testfile: {cur/size*100:.2f}%')
-        except:
-            pass
-        time.sleep(1)
-    p.wait()
-    if p.returncode != 0:
-        err(f"Failed to create testfile (exit code {p.returncode})")
+            off = 0
+            last_report = time.monotonic()
+            while off < size:
+                n = min(size - off, chunk)
+                if n < chunk:
+                    # the unaligned tail can't be written with O_DIRECT
+                    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+                off += os.pwrite(fd, buf[:n], off)
+                now = time.monotonic()
+                if now - last_report >= 1:
+                    info(cfg, f'Creating {size/(1<<30):.2f}G testfile: {off/size*100:.2f}%')
+                    last_report = now
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        err(f'Failed to create testfile ({e})')
         sys.exit(1)
 
-def outfile_path(name):
-    return f'iocost-coef-fio-output-{name}.json'
+def load_json(path):
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def outfile_path(name, ext='json'):
+    return f'iocost-coef-fio-output-{name}.{ext}'
+
+def fio_global_opts(cfg, testfile, duration, jobs):
+    args = cfg.args
+    opts = ['direct=1', f'ioengine={args.ioengine}', f'filename={testfile}',
+            f'runtime={round(duration)}', 'time_based', f'numjobs={jobs}']
+    if args.ioengine == 'io_uring':
+        opts += ['registerfiles', 'fixedbufs']
+    return opts
+
+def fio_job_opts(cfg, iotype, iodepth, blocksize, jobs, rate_iops):
+    opts = [f'readwrite={iotype}', f'iodepth={iodepth}',
+            f'blocksize={blocksize}']
+    if iotype in ('read', 'write'):
+        # give each sequential job its own region so that the streams
+        # don't run over the LBAs another job just touched
+        region = cfg.target_size // jobs // blocksize * blocksize
+        if jobs > 1 and region > 0:
+            opts += [f'size={region}', f'offset_increment={region}']
+    else:
+        # the random map is large on big targets and we don't need every
+        # block to be hit exactly once
+        opts += ['norandommap', 'random_generator=tausworthe64']
+    if 'read' in iotype:
+        opts.append('invalidate=1')
+    # submit in batches but reap completions as soon as any are available
+    # so that the queue stays full at the requested depth
+    if iodepth > 1:
+        opts += [f'iodepth_batch_submit={max(min(iodepth // 8, 16), 1)}',
+                 'iodepth_batch_complete_min=1']
+    if rate_iops is not None:
+        opts.append(f'rate_iops={rate_iops}')
+    return opts
 
-def run_fio(testfile, duration, iotype, iodepth, blocksize, jobs, rate_iops, outfile):
-    global args
+def load_terse(path):
+    with open(path, 'r') as f:
+        return [line.strip().split(';') for line in f if line.startswith('3;')]
 
+# @fmt is either 'json' or 'terse'. The latter is a lot cheaper to produce
+# and parse but lacks the detailed latency distribution.
+def exec_fio(cfg, cmd, outfile, fmt='json'):
+    args = cfg.args
     eta = 'never' if args.quiet else 'always'
-    cmd = (f'fio --direct=1 --ioengine=libaio --name=coef '
-           f'--filename={testfile} --runtime={round(duration)} '
-           f'--readwrite={iotype} --iodepth={iodepth} --blocksize={blocksize} '
-           f'--eta={eta} --output-format json --output={outfile} '
-           f'--time_based --numjobs={jobs} --iodepth_batch_submit={math.ceil(iodepth/16)}')
-    if rate_iops is not None:
-        cmd += f' --rate_iops={rate_iops}'
-    if not sys.stderr.isatty():
-        cmd += " | stdbuf -oL tr '\r' '\n'"
+    cmd = cmd + [f'--eta={eta}', '--output-format', fmt,
+                 f'--output={outfile}']
+    if fmt == 'terse':
+        cmd.append('--terse-version=3')
     if args.verbose:
-        dbg(f'Running {cmd}')
-    subprocess.check_call(cmd, shell=True)
-    with open(outfile, 'r') as f:
-        d = json.load(f)
-    return sum(j['read']['bw_bytes'] + j['write']['bw_bytes'] for j in d['jobs'])
-
-def restore_elevator_nomerges():
-    global elevator_path, nomerges_path, elevator, nomerges
-
-    info(f'Restoring elevator to {elevator} and nomerges to {nomerges}')
-    with open(elevator_path, 'w') as f:
-        f.write(elevator)
-    with open(nomerges_path, 'w') as f:
-        f.write(nomerges)
+        dbg(cfg, f'Running {" ".join(cmd)}')
+    if sys.stderr.isatty():
+        subprocess.check_call(cmd)
+    else:
+        # universal newlines turn fio's eta '\r's into proper line breaks
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1,
+                             universal_newlines=True)
+        for line in p.stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+    return load_json(outfile) if fmt == 'json' else load_terse(outfile)
+
+def run_fio(cfg, testfile, duration, iotype, iodepth, blocksize, jobs, rate_iops, outfile):
+    opts = (fio_global_opts(cfg, testfile, duration, jobs) +
+            fio_job_opts(cfg, iotype, iodepth, blocksize, jobs, rate_iops))
+    return exec_fio(cfg, ['fio', '--name=coef'] + [f'--{opt}' for opt in opts],
+                    outfile)
+
+# Run all @sections, a list of (name, iotype, iodepth, blocksize, stonewall),
+# from a single jobfile. A section with stonewall set waits for all the
+# preceding ones to finish; otherwise, it runs concurrently with them.
+def run_fio_jobfile(cfg, testfile, duration, jobs, sections, outfile):
+    lines = ['[global]'] + fio_global_opts(cfg, testfile, duration, jobs)
+    for (name, iotype, iodepth, blocksize, stonewall) in sections:
+        lines += ['', f'[{name}]']
+        if stonewall:
+            lines.append('stonewall')
+        lines += fio_job_opts(cfg, iotype, iodepth, blocksize, jobs, None)
+
+    with tempfile.NamedTemporaryFile('w', prefix='iocost-coef-',
+                                     suffix='.fio') as jobfile:
+        jobfile.write('\n'.join(lines) + '\n')
+        jobfile.flush()
+        return exec_fio(cfg, ['fio', jobfile.name], outfile, 'terse')
+
+def fio_bps(out, name):
+    # terse v3: jobname at 2, read and write bandwidths in KiB/s at 6 and 47
+    return sum((int(f[6]) + int(f[47])) * 1024 for f in out if f[2] == name)
+
+# sysfs knobs are tiny, skip the python file object layers
+def read_sysfs(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 4096).decode('ascii').strip()
+    finally:
+        os.close(fd)
+
+def write_sysfs(path, val):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.write(fd, val.encode('ascii'))
+    finally:
+        os.close(fd)
+
+def restore_elevator_nomerges(cfg):
+    info(cfg, f'Restoring elevator to {cfg.elevator} and nomerges to {cfg.nomerges}')
+    write_sysfs(cfg.elevator_path, cfg.elevator)
+    write_sysfs(cfg.nomerges_path, cfg.nomerges)
+
+# fio keys the percentiles with strings, parse and sort them numerically once
+# so that read_lat() can bisect the keys
+def pct_table(job, rw):
+    pcts = sorted((float(p), lat)
+                  for p, lat in job[rw]['clat_ns'].get('percentile', {}).items())
+    return ([p for p, _ in pcts], [lat for _, lat in pcts])
 
 def read_lat(pct, table):
-    best_err = 100
-    best_lat = 0
-    for p, lat in table.items():
-        err = abs(float(p) - pct)
-        if err < best_err:
-            best_err = err
-            best_lat = lat
-    return best_lat / 1000   # convert to usecs
-
-def is_ssd():
-    global dev_path
-
-    with open(f'{dev_path}/queue/rotational', 'r') as f:
-        return int(f.read()) == 0
+    keys, lats = table
+    if not keys:
+        return 0
+    # pick the closest neighbor of @pct, ties go to the lower one
+    i = bisect.bisect_left(keys, pct)
+    if i == len(keys) or (i > 0 and pct - keys[i - 1] <= keys[i] - pct):
+        i -= 1
+    return lats[i] / 1000   # convert to usecs
+
+# rotational never changes while we're running
+@functools.lru_cache(maxsize=None)
+def is_ssd(cfg):
+    return int(read_sysfs(f'{cfg.dev_path}/queue/rotational')) == 0
+
+# list each $PATH directory once and return the ones of @cmds not found
+def missing_cmds(cmds):
+    missing = set(cmds)
+    for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        try:
+            found = missing.intersection(os.listdir(d or '.'))
+        except OSError:
+            continue
+        for cmd in found:
+            if os.access(os.path.join(d, cmd), os.X_OK):
+                missing.remove(cmd)
+        if not missing:
+            break
+    return sorted(missing)
 
 def sig_handler(_signo, _stack_frame):
     sys.exit(0)
@@ -188,36 +371,46 @@ def parse_override(ovrstr):
 
     return ovr
 
-def determine_model(args, testfile):
+def determine_model(cfg, testfile):
+    args = cfg.args
     seqio_blksz = args.seqio_block_mb * (2 ** 20)
 
-    info('Determining wbps...')
-    wbps = run_fio(testfile, args.duration, 'write', 1, seqio_blksz,
-                   args.numjobs, None, outfile_path('wbps'))
-    info(f'\nwbps={wbps}, determining rbps...')
-    rbps = run_fio(testfile, args.duration, 'read', 1, seqio_blksz,
-                   args.numjobs, None, outfile_path('rbps'))
-    info(f'\nrbps={rbps}, determining wseqiops...')
-    wseqiops = round(
-        run_fio(testfile, args.duration, 'write', args.seq_depth, 4096,
-                args.numjobs, None, outfile_path('wseqiops')) / 4096)
-    info(f'\nwseqiops={wseqiops}, determining rseqiops...')
-    rseqiops = round(
-        run_fio(testfile, args.duration, 'read', args.seq_depth, 4096,
-                args.numjobs, None, outfile_path('rseqiops')) / 4096)
-    info(f'\nrseqiops={rseqiops}, determining wrandiops...')
-    wrandiops = round(
-        run_fio(testfile, args.duration, 'randwrite', args.rand_depth, 4096,
-                args.numjobs, None, outfile_path('wrandiops')) / 4096)
-    info(f'\nwrandiops={wrandiops}, determining rrandiops...')
-    rrandiops = round(
-        run_fio(testfile, args.duration, 'randread', args.rand_depth, 4096,
-                args.numjobs, None, outfile_path('rrandiops')) / 4096)
-    info(f'\nrrandiops={rrandiops}')
-
-    return (rbps, rseqiops, rrandiops, wbps, wseqiops, wrandiops)
-
-def determine_lat(args, testfile, rw, pct, randiops):
+    # each phase is a pair of (name, iotype, iodepth, blocksize) write and
+    # read probes which don't depend on each other's results
+    phases = [(('wbps', 'write', 1, seqio_blksz),
+               ('rbps', 'read', 1, seqio_blksz)),
+              (('wseqiops', 'write', args.seq_depth, 4096),
+               ('rseqiops', 'read', args.seq_depth, 4096)),
+              (('wrandiops', 'randwrite', args.rand_depth, 4096),
+               ('rrandiops', 'randread', args.rand_depth, 4096))]
+
+    # mixing read and write streams wrecks sequential throughput on
+    # rotational devices, only overlap the probes on SSDs
+    parallel = args.parallel_probes and is_ssd(cfg)
+    sections = []
+    for phase in phases:
+        for i, probe in enumerate(phase):
+            sections.append(probe + (i == 0 or not parallel,))
+    names = [s[0] for s in sections]
+
+    if parallel:
+        info(cfg, f'Determining {", ".join(names)} with write and read probes overlapped...')
+    else:
+        info(cfg, f'Determining {", ".join(names)}...')
+    out = run_fio_jobfile(cfg, testfile, args.duration, args.numjobs, sections,
+                          outfile_path('model', 'terse'))
+
+    res = {}
+    for (name, iotype, iodepth, blocksize, stonewall) in sections:
+        bps = fio_bps(out, name)
+        res[name] = bps if name.endswith('bps') else round(bps / 4096)
+    info(cfg, '\n' + ', '.join(f'{name}={res[name]}' for name in names))
+
+    return (res['rbps'], res['rseqiops'], res['rrandiops'],
+            res['wbps'], res['wseqiops'], res['wrandiops'])
+
+def determine_lat(cfg, testfile, rw, pct, randiops):
+    args = cfg.args
     if rw == 'read':
         (rw, io_type, lat_type) = ('read', 'randread', 'rlat')
     elif rw == 'write':
@@ -225,27 +418,43 @@ def determine_lat(args, testfile, rw, pct, randiops):
     else:
         raise Exception(f'invalid rw value "{rw}"')
 
-    info(f'Determining {rw} QoS params...')
-
-    run_fio(testfile, args.duration, io_type, args.rand_depth, 4096,
-            args.numjobs, int(randiops * 0.9), outfile_path(lat_type))
+    info(cfg, f'Determining {rw} QoS params...')
 
-    with open(outfile_path(lat_type), 'r') as f:
-        r = json.load(f)
-        lat = read_lat(pct, r['jobs'][0][rw]['clat_ns']['percentile'])
+    r = run_fio(cfg, testfile, args.duration, io_type, args.rand_depth, 4096,
+                args.numjobs, int(randiops * 0.9), outfile_path(lat_type))
+    lat = read_lat(pct, pct_table(r['jobs'][0], rw))
 
     return round(lat * 1.5)
 
-def determine_qos(args, testfile, rrandiops, wrandiops):
-    if is_ssd():
+# Measure both read and write latencies from a single mixed run. Each
+# direction is rate limited separately and fio's default rwmixread=50
+# splits the issued IOs between them.
+def determine_lat_fused(cfg, testfile, rpct, rrandiops, wpct, wrandiops):
+    args = cfg.args
+    info(cfg, 'Determining read and write QoS params...')
+
+    rate_iops = f'{int(rrandiops * 0.9)},{int(wrandiops * 0.9)}'
+    r = run_fio(cfg, testfile, args.duration, 'randrw', args.rand_depth, 4096,
+                args.numjobs, rate_iops, outfile_path('rwlat'))
+    rlat = read_lat(rpct, pct_table(r['jobs'][0], 'read'))
+    wlat = read_lat(wpct, pct_table(r['jobs'][0], 'write'))
+
+    return (round(rlat * 1.5), round(wlat * 1.5))
+
+def determine_qos(cfg, testfile, rrandiops, wrandiops):
+    if is_ssd(cfg):
         rpct = 95
         wpct = 95
     else:
         rpct = 50
         wpct = 50
 
-    rlat = determine_lat(args, testfile, 'read', rpct, rrandiops)
-    wlat = determine_lat(args, testfile, 'write', wpct, wrandiops)
+    if cfg.args.fused_qos:
+        (rlat, wlat) = determine_lat_fused(cfg, testfile, rpct, rrandiops,
+                                           wpct, wrandiops)
+    else:
+        rlat = determine_lat(cfg, testfile, 'read', rpct, rrandiops)
+        wlat = determine_lat(cfg, testfile, 'write', wpct, wrandiops)
 
     return (rpct, rlat, wpct, wlat, 60, 100)
 
@@ -254,27 +463,26 @@ def determine_qos(args, testfile, rrandiops, wrandiops):
 #
 signal.signal(signal.SIGTERM, sig_handler)
 signal.signal(signal.SIGINT, sig_handler)
-args = parser.parse_args()
+cfg = Cfg(parser.parse_args())
 
-missing = False
-for cmd in [ 'findmnt', 'dd', 'fio', 'stdbuf' ]:
-    if not shutil.which(cmd):
-        err(f'Required command "{cmd}" is missing')
-        missing = True
+missing = missing_cmds([ 'fio' ])
+for cmd in missing:
+    err(f'Required command "{cmd}" is missing')
 if missing:
     sys.exit(1)
 
-if args.testdev:
-    devname = os.path.basename(args.testdev)
+if cfg.args.testdev:
+    devname = os.path.basename(cfg.args.testdev)
     rdev = os.stat(f'/dev/{devname}').st_rdev
     devnr = f'{os.major(rdev)}:{os.minor(rdev)}'
     testfile = f'/dev/{devname}'
-    info(f'Test target: {devname}({devnr})')
+    cfg.target_size = int(read_sysfs(f'/sys/class/block/{devname}/size')) * 512
+    info(cfg, f'Test target: {devname}({devnr})')
 else:
-    if args.testfile_dev:
-        devname = os.path.basename(args.testfile_dev)
+    if cfg.args.testfile_dev:
+        devname = os.path.basename(cfg.args.testfile_dev)
     else:
-        devname = dir_to_dev('.')
+        devname = dir_to_dev(cfg, '.')
 
     devpath = f'/dev/{devname}'
 
@@ -285,51 +493,53 @@ else:
     rdev = os.stat(devpath).st_rdev
     devnr = f'{os.major(rdev)}:{os.minor(rdev)}'
     testfile = 'iocost-coef-fio.testfile'
-    testfile_size = int(args.testfile_size_gb * 2 ** 30)
-    create_testfile(testfile, testfile_size)
-    info(f'Test target: {testfile} on {devname}({devnr})')
-
-dev_path = f'/sys/block/{devname}'
-elevator_path = f'{dev_path}/queue/scheduler'
-nomerges_path = f'{dev_path}/queue/nomerges'
-
-if not is_ssd():
-    args.numjobs = 1
-
-with open(elevator_path, 'r') as f:
-    elevator = re.sub(r'.*\[(.*)\].*', r'\1', f.read().strip())
-with open(nomerges_path, 'r') as f:
-    nomerges = f.read().strip()
-
-info(f'Temporarily disabling elevator and merges')
-atexit.register(restore_elevator_nomerges)
-with open(elevator_path, 'w') as f:
-    f.write('none')
-with open(nomerges_path, 'w') as f:
-    f.write('1')
-
-if args.model_override is None:
+    testfile_size = int(cfg.args.testfile_size_gb * 2 ** 30)
+    create_testfile(cfg, testfile, testfile_size)
+    cfg.target_size = testfile_size
+    info(cfg, f'Test target: {testfile} on {devname}({devnr})')
+
+cfg.dev_path = f'/sys/block/{devname}'
+cfg.elevator_path = f'{cfg.dev_path}/queue/scheduler'
+cfg.nomerges_path = f'{cfg.dev_path}/queue/nomerges'
+
+if not is_ssd(cfg):
+    cfg.args.numjobs = 1
+
+elevator = read_sysfs(cfg.elevator_path)
+# the active one is bracketed, e.g. "mq-deadline [none] bfq"
+(lb, rb) = (elevator.find('['), elevator.find(']'))
+if 0 <= lb < rb:
+    elevator = elevator[lb + 1:rb]
+cfg.elevator = elevator
+cfg.nomerges = read_sysfs(cfg.nomerges_path)
+
+info(cfg, f'Temporarily disabling elevator and merges')
+atexit.register(restore_elevator_nomerges, cfg)
+write_sysfs(cfg.elevator_path, 'none')
+write_sysfs(cfg.nomerges_path, '1')
+
+if cfg.args.model_override is None:
     (rbps, rseqiops, rrandiops, wbps, wseqiops, wrandiops) = \
-        determine_model(args, testfile)
+        determine_model(cfg, testfile)
 else:
-    ovr = parse_override(args.model_override)
+    ovr = parse_override(cfg.args.model_override)
     (rbps, rseqiops, rrandiops, wbps, wseqiops, wrandiops) = \
         (ovr['rbps'], ovr['rseqiops'], ovr['rrandiops'],
          ovr['wbps'], ovr['wseqiops'], ovr['wrandiops'])
 
-if args.qos_override is None:
+if cfg.args.qos_override is None:
     (rpct, rlat, wpct, wlat, vmin, vmax) = \
-        determine_qos(args, testfile, rrandiops, wrandiops)
+        determine_qos(cfg, testfile, rrandiops, wrandiops)
 else:
-    ovr = parse_override(args.qos_override)
+    ovr = parse_override(cfg.args.qos_override)
     (rpct, rlat, wpct, wlat, vmin, vmax) = \
         (ovr['rpct'], ovr['rlat'], ovr['wpct'], ovr['wlat'],
          ovr['min'], ovr['max'])
 
-restore_elevator_nomerges()
+restore_elevator_nomerges(cfg)
 atexit.unregister(restore_elevator_nomerges)
 
-if args.json:
+if cfg.args.json:
     result = {
         'devnr': devnr,
         'model': {
@@ -350,11 +560,11 @@ if args.json:
         },
     }
 
-    info(f'Writing results to {args.json}')
-    with open(args.json, 'w') as f:
+    info(cfg, f'Writing results to {cfg.args.json}')
+    with open(cfg.args.json, 'w') as f:
         json.dump(result, f, indent=4)
 
-info('')
+info(cfg, '')
 print(f'io.cost.model: {devnr} rbps={rbps} rseqiops={rseqiops} '
       f'rrandiops={rrandiops} wbps={wbps} wseqiops={wseqiops} '
       f'wrandiops={wrandiops}')
@@ -2,7 +2,11 @@
 # Copyright (c) Facebook, Inc. and its affiliates
 
 import argparse
+import atexit
+import collections
+import ctypes
 import datetime
+import errno
 import json
 import math
 import multiprocessing
@@ -10,19 +14,69 @@ import os
 import pathlib
 import platform
 import re
+import select
+import shutil
 import signal
+import struct
 import subprocess
 import sys
+import threading
 import time
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from pystemd.dbuslib import DBus
+    from pystemd.systemd1 import Manager, Unit
+except ImportError:
+    DBus = None
+
 
 # Iterate every second
 interval = 1
+# Run the full system config check at least every this many periods even
+# if no change was noticed
+full_check_every = 10
+
+libc = ctypes.CDLL(None, use_errno=True)
 
+NR_CPUS = multiprocessing.cpu_count()
 USER_HZ = os.sysconf(os.sysconf_names["SC_CLK_TCK"])
+USEC_PER_JIFFY = 1_000_000 / USER_HZ
+SELF_PID = os.getpid()
 CGRP_BASE = "/sys/fs/cgroup"
 SL_BASE = "/var/lib/sideloader"
 SVC_SUFFIX = ".service"
+# unit states which systemctl list-units shows by default
+LISTED_UNIT_STATES = [
+    b"active",
+    b"activating",
+    b"deactivating",
+    b"reloading",
+    b"failed",
+]
+# main slice cgroups whose memory.low is checked
+MAIN_MEMORY_LOW_SUBDIRS = [
+    "",
+    "workload-tw.slice/",
+    "workload-tw.slice/*.task/",
+    "workload-tw.slice/*.task/task/",
+]
+MEMINFO_STATIC_RE = re.compile(r"^(MemTotal|SwapTotal):\s+(\d+) kB$", re.M)
+MEMINFO_DYNAMIC_RE = re.compile(r"^(SwapFree|Hugetlb):\s+(\d+) kB$", re.M)
+PRESSURE_FULL_RE = re.compile(r"^full avg10=\S+ avg60=(\S+) avg300=(\S+)", re.M)
+JOBID_RE = re.compile(r"\A[A-Za-z0-9._-]*\Z")
+SD_PART_RE = re.compile(r"^(sd[^0-9]*)[0-9]*$")
+NVME_PART_RE = re.compile(r"^(nvme[^p]*)(p[0-9])?$")
+BTRFS_SUPER_MAGIC = 0x9123683E
 dfl_cfg_file = SL_BASE + "/config.json"
 dfl_job_dir = SL_BASE + "/jobs.d"
 dfl_status_file = SL_BASE + "/status.json"
@@ -94,26 +148,41 @@ def warn(s):
     print(f"WARN: {s}", file=sys.stderr, flush=True)
 
 
+# Emit multiple warnings with a single write
+def warn_lines(lines):
+    sys.stderr.write("".join(f"WARN: {s}\n" for s in lines))
+    sys.stderr.flush()
+
+
 def err(s):
     print(f"ERR: {s}", file=sys.stderr, flush=True)
     sys.exit(1)
 
 
+SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
 def parse_size(s):
-    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
-    split = re.sub(r"([kKmMgGtT])", r" \1 ", s).split()
-    size = 0
-    for i in range(0, len(split), 2):
+    def parse_num(tok):
         try:
-            num = float(split[i])
+            num = float(tok)
         except:
             num = float("nan")
-        if not math.isfinite(num) or (i + 1 < len(split) and split[i + 1] not in units):
+        if not math.isfinite(num):
             raise Exception(f'invalid size "{s}"')
-        if i + 1 < len(split):
-            size += num * units[split[i + 1]]
-        else:
-            size += num
+        return num
+
+    # scan for unit characters, each must be preceded by a number
+    size = 0
+    start = 0
+    for i, c in enumerate(s):
+        if c in "kKmMgGtT":
+            if c not in SIZE_UNITS:
+                raise Exception(f'invalid size "{s}"')
+            size += parse_num(s[start:i]) * SIZE_UNITS[c]
+            start = i + 1
+    if s[start:].strip():
+        size += parse_num(s[start:])
     return int(size)
 
 
@@ -134,12 +203,84 @@ def int_or_max(v, max_val):
     return int(v)
 
 
+# A procfs or cgroupfs file which is accessed repeatedly. The fd is kept open
+# and each read or write is a pread() or pwrite() at offset 0.
+class PseudoFile:
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.flags = (os.O_RDWR if writable else os.O_RDONLY) | os.O_CLOEXEC
+        self.fd = None
+
+    def __open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, self.flags)
+        return self.fd
+
+    # the cgroup may have been removed and recreated, reopen on ENODEV
+    def __retry_stale(self, fn, *args):
+        try:
+            return fn(*args)
+        except OSError as e:
+            if e.errno != errno.ENODEV:
+                raise
+            self.close()
+            return fn(*args)
+
+    def __pread_all(self):
+        self.__open()
+        bufs = []
+        off = 0
+        while True:
+            buf = os.pread(self.fd, 65536, off)
+            if not buf:
+                break
+            bufs.append(buf)
+            off += len(buf)
+        return b"".join(bufs)
+
+    def __pwrite(self, buf):
+        os.pwrite(self.__open(), buf, 0)
+
+    def read_bytes(self):
+        return self.__retry_stale(self.__pread_all)
+
+    def read(self):
+        return self.read_bytes().decode("utf-8")
+
+    def write(self, data):
+        self.__retry_stale(self.__pwrite, data.encode("utf-8"))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+pseudo_files = {}
+
+
+def pseudo_file(path):
+    if path not in pseudo_files:
+        pseudo_files[path] = PseudoFile(path)
+    return pseudo_files[path]
+
+
+@atexit.register
+def close_pseudo_files():
+    for pf in pseudo_files.values():
+        pf.close()
+
+
 def read_lines(path):
-    with open(path, "r", encoding="utf-8") as f:
-        lines = f.read().strip().split("\n")
-        if len(lines) == 1 and not len(lines[0]):
-            return []
-        return lines
+    if isinstance(path, PseudoFile):
+        content = path.read()
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+    lines = content.strip().split("\n")
+    if len(lines) == 1 and not len(lines[0]):
+        return []
+    return lines
 
 
 def read_first_line(path):
@@ -147,7 +288,7 @@ def read_first_line(path):
 
 
 def read_cpu_idle():
-    toks = read_first_line("/proc/stat").split()[1:]
+    toks = read_first_line(pseudo_file("/proc/stat")).split()[1:]
     idle = int(toks[3]) + int(toks[4])
     total = 0
     for tok in toks:
@@ -155,44 +296,74 @@ def read_cpu_idle():
     return idle, total
 
 
-def read_meminfo():
-    mem_total = None
-    swap_total = None
-    swap_free = None
-    hugetlb = None
+def kb_to_bytes(vals, key):
+    if key not in vals:
+        return None
+    return int(vals[key]) * 1024
 
-    with open("/proc/meminfo", "r", encoding="utf-8") as f:
-        for line in f:
-            toks = line.split()
-            if toks[0] == "MemTotal:":
-                mem_total = int(toks[1]) * 1024
-            elif toks[0] == "SwapTotal:":
-                swap_total = int(toks[1]) * 1024
-            elif toks[0] == "SwapFree:":
-                swap_free = int(toks[1]) * 1024
-            elif toks[0] == "Hugetlb:":
-                hugetlb = int(toks[1]) * 1024
 
+# MemTotal and SwapTotal only change on memory hotplug and swapon/swapoff.
+# They're cached and only re-read when @refresh is set, which SysChecker
+# does on each check.
+meminfo_static = None
+
+
+def read_meminfo_static(refresh=False):
+    global meminfo_static
+
+    if meminfo_static is None or refresh:
+        vals = dict(MEMINFO_STATIC_RE.findall(pseudo_file("/proc/meminfo").read()))
+        meminfo_static = (kb_to_bytes(vals, "MemTotal"), kb_to_bytes(vals, "SwapTotal"))
+
+    return meminfo_static
+
+
+def read_meminfo_dynamic():
+    vals = dict(MEMINFO_DYNAMIC_RE.findall(pseudo_file("/proc/meminfo").read()))
+    return kb_to_bytes(vals, "Hugetlb"), kb_to_bytes(vals, "SwapFree")
+
+
+def read_meminfo(refresh=False):
+    mem_total, swap_total = read_meminfo_static(refresh)
+    hugetlb, swap_free = read_meminfo_dynamic()
     return mem_total, hugetlb, swap_total, swap_free
 
 
-def read_memswap(cgrp_dir):
-    mem_total, hugetlb, swap_total, swap_free = read_meminfo()
-    swap_max = int_or_max(read_first_line(f"{cgrp_dir}/memory.swap.max"), swap_total)
-    swap_cur = int(read_first_line(f"{cgrp_dir}/memory.swap.current"))
+def read_memswap(cgrp_dir, refresh=False):
+    mem_total, hugetlb, swap_total, swap_free = read_meminfo(refresh)
+    swap_max = int_or_max(
+        read_first_line(pseudo_file(f"{cgrp_dir}/memory.swap.max")), swap_total
+    )
+    swap_cur = int(read_first_line(pseudo_file(f"{cgrp_dir}/memory.swap.current")))
     swap_avail = min(swap_total, swap_max)
     swap_free = max(min(swap_avail - swap_cur, swap_free), 0)
 
     return mem_total, hugetlb, swap_avail, swap_free
 
 
-def read_cgroup_keyed(path):
-    content = {}
-    for line in read_lines(path):
-        toks = line.split()
-        key = toks[0]
-        content[key] = toks[1]
-    return content
+# Look up a single key in a flat keyed file without splitting the rest
+def read_cgroup_key(pf, key):
+    buf = pf.read_bytes()
+    needle = key.encode("utf-8") + b" "
+    if buf.startswith(needle):
+        pos = 0
+    else:
+        pos = buf.find(b"\n" + needle) + 1
+        if not pos:
+            raise KeyError(key)
+    start = pos + len(needle)
+    end = buf.find(b"\n", start)
+    return buf[start : end if end >= 0 else len(buf)]
+
+
+# Returns the filesystem magic number of @path. f_type is the leading word of
+# struct statfs and the buffer is larger than the whole struct.
+def statfs_type(path):
+    buf = ctypes.create_string_buffer(256)
+    if libc.statfs(os.fsencode(path), buf) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    return ctypes.c_long.from_buffer(buf).value & 0xFFFFFFFF
 
 
 def read_cgroup_nested_keyed(path):
@@ -207,16 +378,166 @@ def read_cgroup_nested_keyed(path):
     return content
 
 
+# Returns the "full" avg60 and avg300 of a PSI file
+def read_pressure_full(pf):
+    m = PRESSURE_FULL_RE.search(pf.read())
+    if m is None:
+        raise Exception(f'failed to parse "full" pressure in {pf.path}')
+    return float(m.group(1)), float(m.group(2))
+
+
+# Walk the cgroup hierarchy under @base and yield the paths of the files
+# named @filename. Cgroups may go away while walking, ignore them.
+def scan_cgroup_files(base, filename):
+    dirs = [base]
+    while dirs:
+        try:
+            with os.scandir(dirs.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.name == filename:
+                        yield entry.path
+        except FileNotFoundError:
+            pass
+
+
+# Compact single-line encoding
+def json_bytes(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
+
 def dump_json(data, path):
-    dirname, basename = os.path.split(path)
-    with open(
-        os.path.join(dirname, "P{}-{}.tmp".format(os.getpid(), basename)), "w"
-    ) as tf:
-        tf.write(json.dumps(data, sort_keys=True, indent=4))
-        tf_name = tf.name
+    if orjson is not None:
+        buf = orjson.dumps(data, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
+    else:
+        buf = json.dumps(data, sort_keys=True, indent=2).encode("utf-8")
+
+    tf_name = f"{path}.P{SELF_PID}.tmp"
+    fd = os.open(tf_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+    try:
+        view = memoryview(buf)
+        while len(view):
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
     os.rename(tf_name, path)
 
 
+# Writes JSON files from a background thread so that slow storage can't
+# delay the main loop. Only the latest data for each path is kept and
+# older data which hasn't been written yet is dropped. The data must not
+# be modified after being handed over.
+class JsonWriter:
+    def __init__(self):
+        self.pending = {}
+        self.cv = threading.Condition()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def write(self, data, path):
+        with self.cv:
+            self.pending[path] = data
+            self.cv.notify()
+
+    def __run(self):
+        while True:
+            with self.cv:
+                while not len(self.pending):
+                    self.cv.wait()
+                pending = self.pending
+                self.pending = {}
+
+            for path, data in pending.items():
+                try:
+                    dump_json(data, path)
+                except Exception as e:
+                    warn(f"Failed to write {path} ({e})")
+
+
+systemd_bus_conn = None
+
+
+def systemd_bus():
+    global systemd_bus_conn
+
+    if systemd_bus_conn is None:
+        systemd_bus_conn = DBus(system=True)
+        systemd_bus_conn.open()
+    return systemd_bus_conn
+
+
+systemd_manager_obj = None
+
+
+def systemd_manager():
+    global systemd_manager_obj
+
+    if systemd_manager_obj is None:
+        systemd_manager_obj = Manager(bus=systemd_bus())
+        systemd_manager_obj.load()
+    return systemd_manager_obj
+
+
+# Watches files with inotify and tells whether any of them changed since
+# the last call to changed(). If inotify isn't available, everything is
+# always considered changed.
+class ChangeWatcher:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_IGNORED = 0x00008000
+    EVENT_HDR = struct.Struct("iIII")
+
+    def __init__(self):
+        self.fd = None
+        self.wds = {}
+        self.paths = set()
+        try:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except Exception as e:
+            warn(f"inotify not available, can't watch for changes ({e})")
+            return
+        if fd < 0:
+            warn(f"inotify_init1 failed ({os.strerror(ctypes.get_errno())})")
+            return
+        self.fd = fd
+
+    def watch(self, path, mask=IN_MODIFY | IN_ATTRIB):
+        if self.fd is None or path in self.paths:
+            return
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd >= 0:
+            self.wds[wd] = path
+            self.paths.add(path)
+
+    def changed(self):
+        if self.fd is None:
+            return True
+
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return changed
+            changed = True
+            # watches go away with the files, forget them so that they
+            # can be re-added
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _cookie, nlen = self.EVENT_HDR.unpack_from(buf, pos)
+                pos += self.EVENT_HDR.size + nlen
+                if mask & self.IN_IGNORED and wd in self.wds:
+                    self.paths.discard(self.wds.pop(wd))
+
+
 def svc_to_jobid(svc):
     global args
 
@@ -237,7 +558,7 @@ def time_interval(at, now):
 #
 class Config:
     def __init__(self, cfg):
-        mem_total, hugetlb, swap_total, swap_free = read_meminfo()
+        mem_total, hugetlb, swap_total, swap_free = read_meminfo(refresh=True)
 
         self.main_slice = cfg["main_slice"]
         self.host_slice = cfg["host_slice"]
@@ -277,6 +598,8 @@ class Config:
 
 
 class JobFile:
+    __slots__ = ("ino", "path", "fh")
+
     def __init__(self, ino, path, fh):
         self.ino = ino
         self.path = path
@@ -286,12 +609,33 @@ class JobFile:
         return f"{self.ino}:{self.path}"
 
 
+# Jobs are walked and their fields accessed a few times every tick, keep
+# them compact and attribute access cheap with __slots__.
 class Job:
+    __slots__ = (
+        "jobfile",
+        "jobid",
+        "args",
+        "envs",
+        "frozen_exp",
+        "frozen_at",
+        "done",
+        "kill_why",
+        "kill_written",
+        "killed",
+        "svc_name",
+        "cgrp_dir",
+        "freeze_file",
+        "svc_status",
+        "svc_unit",
+        "working_dir",
+    )
+
     def __init__(self, cfg, jobfile):
-        global args
+        global args, config
 
         jobid = cfg["id"]
-        if not re.search("^[A-Za-z0-9-_.]*$", jobid):
+        if not JOBID_RE.match(jobid):
             raise Exception(f'"{jobid}" is not a valid identifier')
 
         frozen_exp = None
@@ -306,9 +650,13 @@ class Job:
         self.frozen_at = None
         self.done = False
         self.kill_why = None
+        self.kill_written = False
         self.killed = False
         self.svc_name = f"{args.svc_prefix}{jobid}{SVC_SUFFIX}"
+        self.cgrp_dir = f"{CGRP_BASE}/{config.side_slice}/{self.svc_name}"
+        self.freeze_file = PseudoFile(f"{self.cgrp_dir}/cgroup.freeze", writable=True)
         self.svc_status = None
+        self.svc_unit = None
         self.working_dir = cfg["working_dir"] if "working_dir" in cfg else None
 
     def update_frozen(self, freeze, now):
@@ -320,28 +668,37 @@ class Job:
             self.frozen_at = None
             changed = True
 
-        path = pathlib.Path(
-            f"{CGRP_BASE}/{config.side_slice}/{self.svc_name}/cgroup.freeze"
-        )
-        if not path.exists():
+        try:
+            frozen = int(self.freeze_file.read())
+        except FileNotFoundError:
             if changed:
                 warn(f"Failed to freeze {self.jobid}")
             return
 
-        if int(freeze) == int(read_first_line(path)):
+        if int(freeze) == frozen:
             return
 
-        with path.open("w") as f:
-            f.write(str(int(freeze)))
+        self.freeze_file.write(str(int(freeze)))
 
     def maybe_kill(self):
         if not self.kill_why:
             return
 
-        path = pathlib.Path(
-            f"{CGRP_BASE}/{config.side_slice}/{self.svc_name}/cgroup.procs"
-        )
-        if not path.exists():
+        # cgroup.kill SIGKILLs the whole cgroup in one go without racing
+        # forks, fall back to killing each process on kernels before 5.14
+        try:
+            with open(f"{self.cgrp_dir}/cgroup.kill", "w") as f:
+                f.write("1")
+        except FileNotFoundError:
+            pass
+        else:
+            if not self.kill_written:
+                log(f"JOB: Attempted to kill {self.jobid} through cgroup.kill")
+                self.kill_written = True
+            return
+
+        path = f"{self.cgrp_dir}/cgroup.procs"
+        if not os.path.exists(path):
             return
 
         pids = read_lines(path)
@@ -357,9 +714,23 @@ class Job:
             self.kill_why = why
         self.maybe_kill()
 
-    def refresh_status(self, now):
-        self.svc_status = "<UNKNOWN>"
-
+    def close(self):
+        self.freeze_file.close()
+
+    # load() introspects the unit, do it once and only read the properties
+    # on each refresh
+    def __read_svc_status_dbus(self):
+        unit = self.svc_unit
+        if unit is None:
+            unit = Unit(self.svc_name.encode(), bus=systemd_bus())
+            unit.load()
+            self.svc_unit = unit
+        active = unit.Unit.ActiveState.decode()
+        if active == "failed":
+            return f"failed (Result: {unit.Service.Result.decode()})"
+        return f"{active} ({unit.Unit.SubState.decode()})"
+
+    def __read_svc_status_systemctl(self):
         out = subprocess.run(
             ["systemctl", "status", self.svc_name],
             stdout=subprocess.PIPE,
@@ -368,8 +739,23 @@ class Job:
         for line in out.split("\n"):
             toks = line.split(maxsplit=1)
             if len(toks) == 2 and toks[0] == "Active:":
-                self.svc_status = toks[1]
-                break
+                return toks[1]
+        return "<UNKNOWN>"
+
+    def refresh_status(self, now):
+        self.svc_status = "<UNKNOWN>"
+
+        # Query systemd directly if pystemd is available, which avoids
+        # forking systemctl for every job on every tick.
+        if DBus is not None:
+            try:
+                self.svc_status = self.__read_svc_status_dbus()
+            except Exception as e:
+                self.svc_unit = None
+                dbg(f"Failed to query {self.svc_name} status over dbus ({e})")
+                self.svc_status = self.__read_svc_status_systemctl()
+        else:
+            self.svc_status = self.__read_svc_status_systemctl()
 
         if "(exited)" in self.svc_status:
             self.done = True
@@ -382,9 +768,18 @@ class Job:
 class SysInfo:
     def __init__(self, pressure_dir, nr_hist_intvs):
         self.pressure_dir = pressure_dir
-        self.cpu_total_hist = [None] * (nr_hist_intvs + 1)
-        self.cpu_idle_hist = [None] * (nr_hist_intvs + 1)
-        self.cpu_side_hist = [None] * (nr_hist_intvs + 1)
+        self.cpu_stat_file = pseudo_file(f"{CGRP_BASE}/{config.side_slice}/cpu.stat")
+        self.mem_pressure_file = pseudo_file(f"{pressure_dir}/memory.pressure")
+        self.io_pressure_file = pseudo_file(f"{pressure_dir}/io.pressure")
+        # ring buffers, empty slots are None or NaN w/ numpy
+        if np is not None:
+            self.cpu_total_hist = np.full(nr_hist_intvs + 1, np.nan)
+            self.cpu_idle_hist = np.full(nr_hist_intvs + 1, np.nan)
+            self.cpu_side_hist = np.full(nr_hist_intvs + 1, np.nan)
+        else:
+            self.cpu_total_hist = [None] * (nr_hist_intvs + 1)
+            self.cpu_idle_hist = [None] * (nr_hist_intvs + 1)
+            self.cpu_side_hist = [None] * (nr_hist_intvs + 1)
         self.cpu_hist_idx = 0
         self.memp_1min = 0
         self.memp_5min = 0
@@ -407,10 +802,9 @@ class SysInfo:
 
         # cpu stats
         cpu_idle, cpu_total = read_cpu_idle()
-        cpu_total = cpu_total / USER_HZ * 1_000_000
-        cpu_idle = cpu_idle / USER_HZ * 1_000_000
-        cpu_stat = read_cgroup_keyed(f"{side_cgrp}/cpu.stat")
-        cpu_side = float(cpu_stat["usage_usec"])
+        cpu_total = cpu_total * USEC_PER_JIFFY
+        cpu_idle = cpu_idle * USEC_PER_JIFFY
+        cpu_side = float(read_cgroup_key(self.cpu_stat_file, "usage_usec"))
 
         next_idx = (self.cpu_hist_idx + 1) % len(self.cpu_idle_hist)
         self.cpu_total_hist[next_idx] = cpu_total
@@ -419,13 +813,8 @@ class SysInfo:
         self.cpu_hist_idx = next_idx
 
         # memory and io pressures
-        pres = read_cgroup_nested_keyed(self.pressure_dir + "/memory.pressure")
-        self.memp_1min = float(pres["full"]["avg60"])
-        self.memp_5min = float(pres["full"]["avg300"])
-
-        pres = read_cgroup_nested_keyed(self.pressure_dir + "/io.pressure")
-        self.iop_1min = float(pres["full"]["avg60"])
-        self.iop_5min = float(pres["full"]["avg300"])
+        self.memp_1min, self.memp_5min = read_pressure_full(self.mem_pressure_file)
+        self.iop_1min, self.iop_5min = read_pressure_full(self.io_pressure_file)
 
         # swap
         (self.mem_total, self.hugetlb, self.swap_avail, self.swap_free) = read_memswap(
@@ -439,7 +828,8 @@ class SysInfo:
         assert nr_intvs > 0 and nr_intvs < len(self.cpu_idle_hist)
         ridx = self.cpu_hist_idx
         lidx = (ridx - nr_intvs) % len(self.cpu_idle_hist)
-        if self.cpu_total_hist[lidx] is not None:
+        total = self.cpu_total_hist[lidx]
+        if total is not None and total == total:
             return lidx, ridx
         else:
             return None, None
@@ -450,7 +840,7 @@ class SysInfo:
             return 0
         total = self.cpu_total_hist[ridx] - self.cpu_total_hist[lidx]
         delta = hist[ridx] - hist[lidx]
-        return min(max(delta / total * 100, 0), 100)
+        return float(min(max(delta / total * 100, 0), 100))
 
     def __cpu_min_max(self, hist, nr_intvs):
         pct_min = 100
@@ -459,6 +849,13 @@ class SysInfo:
         if idx is None:
             return 0, 0
 
+        if np is not None:
+            idxs = (np.arange(nr_intvs + 1) + idx) % len(hist)
+            totals = np.diff(self.cpu_total_hist[idxs])
+            deltas = np.diff(hist[idxs])
+            pcts = np.clip(deltas / totals * 100, 0, 100)
+            return float(pcts.min()), float(pcts.max())
+
         while idx != ridx:
             nidx = (idx + 1) % len(self.cpu_idle_hist)
             total = self.cpu_total_hist[nidx] - self.cpu_total_hist[idx]
@@ -494,6 +891,11 @@ class SysChecker:
 
         self.active = False
         self.last_check_at = 0
+        self.nr_skipped_checks = 0
+        self.watcher = ChangeWatcher()
+        # knob files found by the last check, for __watch_knobs()
+        self.io_latency_paths = []
+        self.main_memory_low_paths = []
         self.last_warns = []
         self.warns = []
         self.fixed = False
@@ -507,22 +909,23 @@ class SysChecker:
         self.swappiness = 0
         self.hugetlb = 0
 
+        self.mountinfo = pseudo_file("/proc/self/mountinfo")
+        self.mountinfo_poll = None
+        self.root_mount = None
+
         # find the root device maj/min
         if args.dev is None:
-            for line in read_lines("/proc/mounts"):
-                toks = line.split()
-                if toks[1] == "/":
-                    if toks[0].startswith("/dev/"):
-                        self.root_part = toks[0][len("/dev/") :]
-                    break
+            root_mount = self.__root_mount()
+            if root_mount is not None and root_mount[0].startswith("/dev/"):
+                self.root_part = root_mount[0][len("/dev/") :]
             if self.root_part is None:
                 warn("SYSCFG: failed to find root mount")
                 return
 
             if self.root_part.startswith("sd"):
-                self.root_dev = re.sub(r"^(sd[^0-9]*)[0-9]*$", r"\1", self.root_part)
+                self.root_dev = SD_PART_RE.sub(r"\1", self.root_part)
             elif self.root_part.startswith("nvme"):
-                self.root_dev = re.sub(r"^(nvme[^p]*)(p[0-9])?$", r"\1", self.root_part)
+                self.root_dev = NVME_PART_RE.sub(r"\1", self.root_part)
             else:
                 raise Exception(f"unknown device {self.root_part}")
         else:
@@ -538,24 +941,58 @@ class SysChecker:
         except Exception as e:
             warn(f"SYSCFG: failed to find root device ({e})")
 
-    def __check_and_fix_rootfs(self):
-        toks = None
-        for line in read_lines("/proc/mounts"):
+    # Returns whether the mount table changed, which the kernel signals with
+    # POLLPRI on mountinfo. The event is reported only once, so this must be
+    # the only place polling. Drops the cached root mount entry if changed.
+    def __mounts_changed(self):
+        if self.mountinfo_poll is None or not self.mountinfo_poll.poll(0):
+            return False
+        self.root_mount = None
+        return True
+
+    # Returns (source, fstype, options) of the root mount. The entry is
+    # cached until __mounts_changed() drops it.
+    def __root_mount(self):
+        if self.root_mount is not None:
+            return self.root_mount
+
+        for line in read_lines(self.mountinfo):
             toks = line.split()
-            if toks[1] == "/":
+            if toks[4] == "/":
+                # optional fields are terminated by "-", followed by fstype,
+                # source and super options
+                sep = toks.index("-", 6)
+                self.root_mount = (
+                    toks[sep + 2],
+                    toks[sep + 1],
+                    f"{toks[5]},{toks[sep + 3]}",
+                )
                 break
 
-        if toks is None or toks[1] != "/":
+        if self.mountinfo_poll is None:
+            self.mountinfo_poll = select.poll()
+            self.mountinfo_poll.register(self.mountinfo.fd, select.POLLPRI)
+        return self.root_mount
+
+    def __check_and_fix_rootfs(self):
+        try:
+            if statfs_type("/") != BTRFS_SUPER_MAGIC:
+                return ["root filesystem is not btrfs"]
+        except OSError as e:
+            return [f"failed to statfs root fs ({e})"]
+
+        root_mount = self.__root_mount()
+        if root_mount is None:
             return ["failed to find root fs mount entry"]
 
-        if toks[2] != "btrfs":
-            return ["root filesystem is not btrfs"]
+        _source, _fstype, options = root_mount
 
-        if "discard=async" in toks[3]:
+        if "discard=async" in options:
             return []
 
         fixed = ""
         if self.fix:
+            self.root_mount = None
             try:
                 subprocess.check_call(["mount", "-o", "remount,discard=async", "/"])
             except Exception as e:
@@ -567,13 +1004,15 @@ class SysChecker:
         return [f"async discard disabled on root fs{fixed}"]
 
     def __check_memswap(self):
-        global config
+        global config, sysinfo
 
         warns = []
 
-        (self.mem_total, self.hugetlb, self.swap_avail, self.swap_free) = read_memswap(
-            self.side_cgrp
-        )
+        # sysinfo has already read these for this tick
+        self.mem_total = sysinfo.mem_total
+        self.hugetlb = sysinfo.hugetlb
+        self.swap_avail = sysinfo.swap_avail
+        self.swap_free = sysinfo.swap_free
 
         if self.swap_avail < 0.9 * (self.mem_total / 4):
             warns.append(
@@ -602,21 +1041,21 @@ class SysChecker:
 
     def __check_and_fix_io_latency_off(self):
         warns = []
-        root_path = pathlib.Path(CGRP_BASE)
-        for path in root_path.glob("**/io.latency"):
+        self.io_latency_paths = list(scan_cgroup_files(CGRP_BASE, "io.latency"))
+        for path in self.io_latency_paths:
             try:
                 latcfg = read_cgroup_nested_keyed(path)
                 if self.root_devnr not in latcfg:
                     continue
                 fixed = ""
                 if self.fix:
-                    with path.open("w") as f:
+                    with open(path, "w") as f:
                         f.write(f"{self.root_devnr} target=0")
                     self.fixed = True
                     fixed = ", disabled"
-                warns.append(f"{str(path)} has non-null config{fixed}")
+                warns.append(f"{path} has non-null config{fixed}")
             except Exception as e:
-                warns.append(f"failed to check and disable {str(path)} ({e})")
+                warns.append(f"failed to check and disable {path} ({e})")
         return warns
 
     def __check_and_fix_main_memory_low(self):
@@ -624,15 +1063,12 @@ class SysChecker:
         warns = []
 
         main_memory_low = None
+        self.main_memory_low_paths = []
         try:
             main_path = pathlib.Path(self.main_cgrp)
-            for subdir in (
-                "",
-                "workload-tw.slice/",
-                "workload-tw.slice/*.task/",
-                "workload-tw.slice/*.task/task/",
-            ):
+            for subdir in MAIN_MEMORY_LOW_SUBDIRS:
                 for path in main_path.glob(f"{subdir}memory.low"):
+                    self.main_memory_low_paths.append(path)
                     low = int_or_max(read_first_line(path), self.mem_total)
                     if low < (self.mem_total - self.hugetlb) / 3:
                         if main_memory_low:
@@ -710,14 +1146,14 @@ class SysChecker:
             line = read_first_line(f"{CGRP_BASE}/{slice}/{knob}")
             if prefix:
                 line = line.split()[1]
-            weight = int(line)
+            observed = int(line)
         except Exception as e:
             return [f"failed to check {slice}/{knob} ({e})"]
 
-        if weight == weight:
+        if observed == weight:
             return []
         else:
-            return [f"{slice}/{knob} != {weight}"]
+            return [f"{slice}/{knob} ({observed}) != {weight}"]
 
     def __update_weight(self, slice, knob, weight, systemd_key=None, prefix=None):
         try:
@@ -865,10 +1301,7 @@ class SysChecker:
         # log if changed
         if self.warns != self.last_warns:
             if len(self.warns):
-                i = 0
-                for w in self.warns:
-                    warn(f"SYSCFG[{i}]: {w}")
-                    i += 1
+                warn_lines(f"SYSCFG[{i}]: {w}" for i, w in enumerate(self.warns))
             else:
                 log("SYSCFG: all good")
 
@@ -877,10 +1310,60 @@ class SysChecker:
         self.__check(now)
         if self.fixed:
             self.__check(now)
+        self.__watch_knobs()
+        self.watcher.changed()
+        self.nr_skipped_checks = 0
+        # pick up swapon/swapoff from the next sysinfo update on
+        read_meminfo_static(refresh=True)
+
+    # The knobs checked above change only on admin action or through
+    # our own fixes. Watch them so that periodic_check() can tell whether
+    # a full check is needed. To keep the number of watches bounded and
+    # unrelated units coming and going from forcing full checks, only the
+    # top-level slices and the main slice cgroups are watched. Nested
+    # io.latency changes and new cgroups elsewhere are left to the periodic
+    # full check.
+    def __watch_knobs(self):
+        global config
 
+        dir_mask = ChangeWatcher.IN_CREATE | ChangeWatcher.IN_DELETE
+        watcher = self.watcher
+        watcher.watch(CGRP_BASE, dir_mask)
+        for path in self.io_latency_paths:
+            if os.path.dirname(os.path.dirname(path)) == CGRP_BASE:
+                watcher.watch(path)
+        for path in self.main_memory_low_paths:
+            watcher.watch(str(path))
+            watcher.watch(str(path.parent), dir_mask)
+        watcher.watch(f"{CGRP_BASE}/cgroup.subtree_control")
+        watcher.watch(f"{CGRP_BASE}/io.cost.qos")
+        watcher.watch("/proc/sys/vm/swappiness")
+        watcher.watch(f"{self.side_cgrp}/memory.high")
+        for cgrp in (self.main_cgrp, self.host_cgrp, self.side_cgrp):
+            watcher.watch(f"{cgrp}/cpu.weight")
+            watcher.watch(f"{cgrp}/io.weight")
+
+    # Run the full check if there were warnings, anything watched or the
+    # root mount changed, or it has been skipped for too long. Otherwise,
+    # only check memswap which can't be watched.
     def periodic_check(self, intv, now):
-        if now - self.last_check_at >= intv:
+        if now - self.last_check_at < intv:
+            return
+
+        # always consume the mountinfo event so that check() sees a fresh entry
+        mounts_changed = self.__mounts_changed()
+        if (
+            len(self.warns)
+            or mounts_changed
+            or self.watcher.changed()
+            or self.root_mount is None
+            or self.nr_skipped_checks >= full_check_every
+            or len(self.__check_memswap())
+        ):
             self.check(now)
+        else:
+            self.last_check_at = now
+            self.nr_skipped_checks += 1
 
     def update_active(self, active):
         global args
@@ -911,6 +1394,7 @@ class SysChecker:
                     )
 
         self.active = active
+        self.nr_skipped_checks = full_check_every
 
 
 class Scriber:
@@ -919,34 +1403,68 @@ class Scriber:
         self.interval = intv
         self.last_at = 0
         self.scribe_proc = None
+        self.pending = b""
         self.disabled = False
 
     def should_log(self, now):
-        if int(now) - int(self.last_at) < self.interval:
-            return False
-
-        if self.scribe_proc and self.scribe_proc.poll() is None:
-            return False
+        return int(now) - int(self.last_at) >= self.interval
+
+    # A single scribe_cat is kept running and fed one message per line
+    # through its stdin. The pipe is non-blocking so that a stalled
+    # scribe_cat makes us drop messages instead of stalling the loop.
+    def __spawn(self):
+        self.pending = b""
+        self.scribe_proc = subprocess.Popen(
+            ["scribe_cat", self.category], stdin=subprocess.PIPE, bufsize=0
+        )
+        os.set_blocking(self.scribe_proc.stdin.fileno(), False)
 
-        return True
+    # Write as much of @buf as the pipe takes and remember the rest.
+    # Returns whether all of it went through.
+    def __write(self, buf):
+        written = self.scribe_proc.stdin.write(buf)
+        self.pending = buf[written or 0 :]
+        return not len(self.pending)
 
     def log(self, msg, now):
         if self.disabled:
             return
         self.last_at = now
-        if self.scribe_proc:
-            self.scribe_proc.wait()
-        try:
-            self.scribe_proc = subprocess.Popen(["scribe_cat", self.category, msg])
-        except Exception as e:
-            warn(f"Failed to run scribe_cat ({e}), disabling scribe logging")
-            self.disabled = True
+
+        for retry in (False, True):
+            try:
+                if self.scribe_proc is None or self.scribe_proc.poll() is not None:
+                    self.__spawn()
+                # finish the previous message first
+                if not len(self.pending) or self.__write(self.pending):
+                    self.__write(msg + b"\n")
+                else:
+                    dbg("scribe_cat is falling behind, dropping message")
+                return
+            except BrokenPipeError as e:
+                # scribe_cat went away, restart it once
+                self.scribe_proc = None
+                if retry:
+                    warn(f"Failed to write to scribe_cat ({e}), dropping message")
+            except Exception as e:
+                warn(f"Failed to run scribe_cat ({e}), disabling scribe logging")
+                self.disabled = True
+                return
 
 
 #
 # Implementation
 #
-def list_side_services():
+def list_side_services_dbus():
+    global args
+
+    units = systemd_manager().Manager.ListUnitsByPatterns(
+        LISTED_UNIT_STATES, [f"{args.svc_prefix}*{SVC_SUFFIX}".encode()]
+    )
+    return [unit[0].decode() for unit in units]
+
+
+def list_side_services_systemctl():
     global config, args
 
     out = subprocess.run(
@@ -964,22 +1482,36 @@ def list_side_services():
     return svcs
 
 
+def list_side_services():
+    if DBus is not None:
+        try:
+            return list_side_services_dbus()
+        except Exception as e:
+            dbg(f"Failed to list side services over dbus ({e})")
+    return list_side_services_systemctl()
+
+
 def process_job_dir(jobfiles, jobs, now):
     global args
 
-    job_dir_path = pathlib.Path(args.jobdir)
     input_jobfiles = {}
 
-    # Open all job files.
-    for path in job_dir_path.glob("*"):
-        try:
-            if path.is_symlink() or not path.is_file():
-                raise Exception("Invalid file type")
-            fh = path.open("r", encoding="utf-8")
-            ino = os.fstat(fh.fileno()).st_ino
-            input_jobfiles[ino] = JobFile(ino, str(path), fh)
-        except Exception as e:
-            warn(f"Failed to open {path} ({e})")
+    # Open the new job files. The type and inode number come from the
+    # directory entries, files which are already loaded aren't touched.
+    with os.scandir(args.jobdir) as it:
+        for entry in it:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    raise Exception("Invalid file type")
+                ino = entry.inode()
+                if ino in jobfiles:
+                    input_jobfiles[ino] = jobfiles[ino]
+                    continue
+                fh = open(entry.path, "r", encoding="utf-8")
+                ino = os.fstat(fh.fileno()).st_ino
+                input_jobfiles[ino] = JobFile(ino, entry.path, fh)
+            except Exception as e:
+                warn(f"Failed to open {entry.path} ({e})")
 
     # Let's find out which files are gone and which are new.
     gone_jobfiles = []
@@ -1029,7 +1561,7 @@ def process_job_dir(jobfiles, jobs, now):
                 jf_jobids.add(job.jobid)
                 jf_jobs[job.jobid] = job
         except Exception as e:
-            warn(f"Failed to load {path} ({e})")
+            warn(f"Failed to load {jf.path} ({e})")
         else:
             jobfiles[jf.ino] = jf
             jobids = jobids.union(jf_jobids)
@@ -1041,43 +1573,108 @@ def process_job_dir(jobfiles, jobs, now):
     return jobs_to_kill, jobs_to_start
 
 
-def count_active_jobs(jobs):
-    count = 0
-    for _jobid, job in jobs.items():
-        if job.frozen_at is None and not job.done:
-            count += 1
-    return count
+# Equivalent of the systemd-run invocation below through StartTransientUnit
+def start_job_dbus(job):
+    global config
 
+    # systemd-run resolves the executable on the client side, do the same
+    exe = job.args[0]
+    if "/" in exe:
+        exe = os.path.abspath(exe)
+    else:
+        exe = shutil.which(exe)
+        if exe is None:
+            raise Exception(f"{job.args[0]} not found")
+
+    props = {
+        b"Description": " ".join(job.args).encode(),
+        b"ExecStart": [(exe.encode(), [arg.encode() for arg in job.args], False)],
+        b"RemainAfterExit": True,
+        b"TimeoutStopUSec": 5_000_000,
+        b"IOAccounting": True,
+        b"Slice": config.side_slice.encode(),
+    }
+    if job.working_dir is not None:
+        props[b"WorkingDirectory"] = job.working_dir.encode()
+    if len(job.envs):
+        props[b"Environment"] = [env.encode() for env in job.envs]
 
-def count_frozen_jobs(jobs):
-    count = 0
-    for _jobid, job in jobs.items():
-        if job.frozen_at is not None:
-            count += 1
-    return count
+    systemd_manager().Manager.StartTransientUnit(job.svc_name.encode(), b"fail", props)
 
 
-def config_cpu_max(pct):
+def start_job_systemd_run(job):
     global config
 
-    cpu_max_file = f"{CGRP_BASE}/{config.side_slice}/cpu.max"
+    cmd = [
+        "systemd-run",
+        "-r",
+        "-p",
+        "TimeoutStopSec=5",
+        "-p",
+        "IOAccounting=true",
+        "--slice",
+        config.side_slice,
+        "--unit",
+        job.svc_name,
+    ]
+    if job.working_dir is not None:
+        cmd += ["--working-directory", job.working_dir]
+    for env in job.envs:
+        cmd += ["-E", env]
+    cmd += job.args
+    subprocess.run(cmd)
+
+
+def start_job(job):
+    if DBus is not None:
+        try:
+            start_job_dbus(job)
+            return
+        except Exception as e:
+            dbg(f"Failed to start {job.svc_name} over dbus ({e})")
+    start_job_systemd_run(job)
+
+
+# The last cpu.max config read or written is cached and the file is re-read
+# only if it changed since, e.g. systemd re-applying the slice's properties.
+def config_cpu_max(pct):
+    global config, cpu_max_file, cpu_max_watcher, cpu_max_last
+
     period = int(config.cpu_throttle_period * 1_000_000)
-    quota = int(multiprocessing.cpu_count() * period * pct / 100)
+    quota = int(NR_CPUS * period * pct / 100)
+
+    cpu_max_watcher.watch(cpu_max_file.path)
+    if cpu_max_watcher.changed():
+        cpu_max_last = None
+    if cpu_max_last == (quota, period):
+        return
 
     try:
         cur_quota, cur_period = read_first_line(cpu_max_file).split()
         cur_quota = 100 if cur_quota == "max" else int(cur_quota)
         cur_period = int(cur_period)
+        cpu_max_last = (cur_quota, cur_period)
         if period == cur_period and quota == cur_quota:
             return
 
-        with open(cpu_max_file, "w") as f:
-            f.write(f"{quota} {period}")
+        cpu_max_file.write(f"{quota} {period}")
+        cpu_max_watcher.changed()
+        cpu_max_last = (quota, period)
     except Exception as e:
-        warn(f"Failed to configure {cpu_max_file} ({e})")
+        cpu_max_last = None
+        warn(f"Failed to configure {cpu_max_file.path} ({e})")
 
 
 # Run
+CONFIG_WATCH_MASK = (
+    ChangeWatcher.IN_MODIFY
+    | ChangeWatcher.IN_ATTRIB
+    | ChangeWatcher.IN_CLOSE_WRITE
+    | ChangeWatcher.IN_DELETE_SELF
+    | ChangeWatcher.IN_MOVE_SELF
+)
+config_watcher = ChangeWatcher()
+config_watcher.watch(args.config, CONFIG_WATCH_MASK)
 config_mod_at = os.path.getmtime(args.config)
 config = Config(json.load(open(args.config, "r"))["sideloader_config"])
 dbg(f"Config: {config.__dict__}")
@@ -1091,8 +1688,12 @@ overload_hold_from = 0
 overload_hold = 0
 overload_why = None
 jobfiles = {}
-jobs_pending = {}
+jobs_pending = collections.OrderedDict()
 jobs = {}
+json_writer = JsonWriter()
+cpu_max_file = PseudoFile(f"{CGRP_BASE}/{config.side_slice}/cpu.max", writable=True)
+cpu_max_watcher = ChangeWatcher()
+cpu_max_last = None
 now = time.time()
 
 nr_cpu_headroom_intvs = math.ceil(config.cpu_headroom_period / interval)
@@ -1139,8 +1740,12 @@ while True:
     last = now
     now = time.time()
 
-    # Apply config change, only cpu headroom can be updated while running
-    if config_mod_at != os.path.getmtime(args.config):
+    # Apply config change, only cpu headroom can be updated while running.
+    # The config file is stat'd only after inotify reported a change. The
+    # watch is dropped if the file gets replaced, re-add it.
+    config_changed = config_watcher.changed()
+    config_watcher.watch(args.config, CONFIG_WATCH_MASK)
+    if config_changed and config_mod_at != os.path.getmtime(args.config):
         config_mod_at = os.path.getmtime(args.config)
         new_cfg = json.load(open(args.config, "r"))["sideloader_config"]
         new_cpu_headroom = float(new_cfg["cpu_headroom"])
@@ -1153,38 +1758,25 @@ while True:
     # Handle job starts and stops
     jobs_to_kill, jobs_to_start = process_job_dir(jobfiles, jobs, now)
 
-    for jobid, job in jobs_to_kill.items():
-        log(f"JOB: Stopping {job.svc_name}")
-        subprocess.run(["systemctl", "stop", job.svc_name])
-        subprocess.run(["systemctl", "reset-failed", job.svc_name])
-        del jobs[jobid]
+    if len(jobs_to_kill):
+        svcs_to_stop = [job.svc_name for job in jobs_to_kill.values()]
+        log(f"JOB: Stopping {svcs_to_stop}")
+        subprocess.run(["systemctl", "stop"] + svcs_to_stop)
+        subprocess.run(["systemctl", "reset-failed"] + svcs_to_stop)
+        for jobid, job in jobs_to_kill.items():
+            job.close()
+            del jobs[jobid]
 
     # Start new jobs iff not overloaded
     jobs_pending.update(jobs_to_start)
     if not overload_at:
-        for jobid, job in jobs_pending.items():
+        while len(jobs_pending):
+            jobid, job = jobs_pending.popitem(last=False)
             log(f"JOB: Starting {job.svc_name}")
             jobs[jobid] = job
-            syschecker.update_active(count_active_jobs(jobs))
-            cmd = [
-                "systemd-run",
-                "-r",
-                "-p",
-                "TimeoutStopSec=5",
-                "-p",
-                "IOAccounting=true",
-                "--slice",
-                config.side_slice,
-                "--unit",
-                job.svc_name,
-            ]
-            if job.working_dir is not None:
-                cmd += ["--working-directory", job.working_dir]
-            for env in job.envs:
-                cmd += ["-E", env]
-            cmd += job.args
-            subprocess.run(cmd)
-        jobs_pending = {}
+            # the new job is active
+            syschecker.update_active(True)
+            start_job(job)
 
     # Read the current system state
     sysinfo.update()
@@ -1260,31 +1852,48 @@ while True:
             log("OVERLOAD: end, resuming normal operation")
             overload_at = None
 
-    if overload_at:
-        for jobid, job in jobs.items():
-            job.update_frozen(True, now)
+    freeze = bool(overload_at)
+    if not freeze:
+        overload_hold = max(overload_hold - config.ov_hold_decay, 0)
+
+    # Freeze or thaw, process frozen timeouts and count in a single pass
+    nr_active = 0
+    nr_frozen = 0
+    for jobid, job in jobs.items():
+        job.update_frozen(freeze, now)
+        if freeze:
             ddbg(f"{jobid} frozen for {int(now - job.frozen_at)}s exp={job.frozen_exp}")
             if now - job.frozen_at >= job.frozen_exp:
                 job.kill("frozen for too long")
-    else:
-        overload_hold = max(overload_hold - config.ov_hold_decay, 0)
-        for _jobid, job in jobs.items():
-            job.update_frozen(False, now)
-
-    # Process frozen timeouts
-    for _jboid, job in jobs.items():
         job.maybe_kill()
 
+        if job.frozen_at is not None:
+            nr_frozen += 1
+        elif not job.done:
+            nr_active += 1
+
     # Configure side's cpu.max and update active state
-    nr_active = count_active_jobs(jobs)
     if nr_active > 0:
         config_cpu_max(cpu_avail)
 
     syschecker.update_active(nr_active)
 
     # Refresh service status and report
-    for _jobid, job in jobs.items():
+    jobs_status = []
+    for jobid, job in jobs.items():
         job.refresh_status(now)
+        jobs_status.append(
+            {
+                "id": jobid,
+                "path": job.jobfile.path,
+                "service_name": job.svc_name,
+                "service_status": job.svc_status,
+                "frozen_for": time_interval(job.frozen_at, now),
+                "is_killed": int(job.killed),
+                "is_done": int(job.done),
+                "kill_why": f'{job.kill_why if job.kill_why else ""}',
+            }
+        )
 
     status = {
         "sideloader_status": {
@@ -1292,20 +1901,8 @@ while True:
             "sysconfig_warnings_at": str(
                 datetime.datetime.fromtimestamp(syschecker.last_check_at)
             ),
-            "sysconfig_warnings": syschecker.warns,
-            "jobs": [
-                {
-                    "id": jobid,
-                    "path": job.jobfile.path,
-                    "service_name": job.svc_name,
-                    "service_status": job.svc_status,
-                    "frozen_for": time_interval(job.frozen_at, now),
-                    "is_killed": int(job.killed),
-                    "is_done": int(job.done),
-                    "kill_why": f'{job.kill_why if job.kill_why else ""}',
-                }
-                for jobid, job in jobs.items()
-            ],
+            "sysconfig_warnings": list(syschecker.warns),
+            "jobs": jobs_status,
             "jobs_pending": [
                 {"id": jobid, "path": job.jobfile.path}
                 for jobid, job in jobs_pending.items()
@@ -1332,7 +1929,7 @@ while True:
             },
         }
     }
-    dump_json(status, args.status)
+    json_writer.write(status, args.status)
 
     if scriber and scriber.should_log(now):
         sstatus = {
@@ -1342,7 +1939,7 @@ while True:
                 "overload": overload_at is not None,
                 "nr-jobs": len(jobs),
                 "nr-active-jobs": nr_active,
-                "nr-frozen-jobs": count_frozen_jobs(jobs),
+                "nr-frozen-jobs": nr_frozen,
                 "nr-pending-jobs": len(jobs_pending),
             },
             "float": {
@@ -1359,7 +1956,7 @@ while True:
             },
             "normal": {"hostname": platform.node()},
         }
-        dump_json(sstatus, args.scribe)
-        scriber.log(json.dumps(sstatus), now)
+        json_writer.write(sstatus, args.scribe)
+        scriber.log(json_bytes(sstatus), now)
 
     time.sleep(interval)
@@ -3,6 +3,7 @@
 
 import os
 import mmap
+import re
 import time
 import math
 import sys
@@ -13,17 +14,18 @@ TF_DIR = "inodesteal-testfiles"
 CHUNK_PAGES = int((256 << 20) / 4096)
 CHUNK_SIZE = CHUNK_PAGES * 4096
 NR_MMS_TO_GIGS = CHUNK_SIZE / GIG
+PAGE_ONES = b"\1" * CHUNK_PAGES
 TRIES = 3
+MEMINFO_RE = re.compile(r"^([^:\s]+):\s+(\d+)( kB)?$", re.M)
+INODESTEAL_RE = re.compile(rb"^(?:pginodesteal|kswapd_inodesteal) (\d+)$", re.M)
+
+vmstat_fd = None
 
 def read_meminfo():
     meminfo = {}
     with open("/proc/meminfo", "r") as f:
-        for line in f.readlines():
-            toks = line.replace(":", " ").split()
-            if len(toks) < 3:
-                meminfo[toks[0]] = int(toks[1])
-            elif toks[2] == "kB":
-                meminfo[toks[0]] = int(toks[1]) * 1024
+        for key, val, kb in MEMINFO_RE.findall(f.read()):
+            meminfo[key] = int(val) * 1024 if kb else int(val)
     return meminfo
 
 def read_vmstat():
@@ -34,9 +36,21 @@ def read_vmstat():
             vmstat[toks[0]] = int(toks[1])
     return vmstat
 
+# Called repeatedly while reading back pages. Keep /proc/vmstat open and
+# pread it from the start each time.
 def read_inodesteal():
-    vmstat = read_vmstat()
-    return vmstat["pginodesteal"] + vmstat["kswapd_inodesteal"]
+    global vmstat_fd
+    if vmstat_fd is None:
+        vmstat_fd = os.open("/proc/vmstat", os.O_RDONLY)
+    bufs = []
+    off = 0
+    while True:
+        buf = os.pread(vmstat_fd, 65536, off)
+        if not buf:
+            break
+        bufs.append(buf)
+        off += len(buf)
+    return sum(int(v) for v in INODESTEAL_RE.findall(b"".join(bufs)))
 
 def one_round(inodesteal_target, prefix):
     with open("/proc/sys/vm/drop_caches", "w") as f:
@@ -67,8 +81,8 @@ def one_round(inodesteal_target, prefix):
     mms = []
     while True:
         mm = mmap.mmap(-1, CHUNK_PAGES * 4096, flags=mmap.MAP_PRIVATE)
-        for i in range(CHUNK_PAGES):
-            mm[i * 4096] = 1
+        # Strided slice store touches every page from C.
+        mm[0:CHUNK_SIZE:4096] = PAGE_ONES
         mi = read_meminfo()
         mms.append(mm)
         if mi["SwapFree"] < target_swap_free:
@@ -86,8 +100,7 @@ def one_round(inodesteal_target, prefix):
     last_at = time.time()
     nr_to_read = min(math.ceil(2 * target_swap / CHUNK_SIZE / 2), len(mms))
     for i in range(nr_to_read):
-        for j in range(CHUNK_PAGES):
-            mms[i][j * 4096]
+        mms[i][0:CHUNK_SIZE:4096]
         if read_inodesteal() >= inodesteal_target:
             return True
         if time.time() >= last_at + 1:
@@ -15,10 +15,17 @@ mm = mmap.mmap(-1, nr_pages * 4096, flags=mmap.MAP_PRIVATE)
 
 last_at = time.time()
 
-for i in range(nr_pages):
-    mm[i * 4096] = 1
-    if time.time() >= last_at + 1 or i == nr_pages - 1:
-        print(f"Touched {i * 4096 / (1 << 30):.2f}G")
+# Touch a chunk of pages at a time with a strided slice assignment, which
+# loops in C instead of storing one byte per page from Python.
+CHUNK_PAGES = 16384
+ones = b"\1" * CHUNK_PAGES
+
+for i in range(0, nr_pages, CHUNK_PAGES):
+    nr = min(CHUNK_PAGES, nr_pages - i)
+    mm[i * 4096 : (i + nr) * 4096 : 4096] = ones[:nr]
+    done = i + nr
+    if time.time() >= last_at + 1 or done == nr_pages:
+        print(f"Touched {done * 4096 / (1 << 30):.2f}G")
         last_at = time.time()
 
 print("Allocation done, sleeping...")
@@ -26,11 +26,54 @@ depth = math.ceil(depth / jobs)
 
 print(f"Reading {size/1024}k with {depth} depth and {jobs} jobs from {dev}", flush=True)
 
-cmd = (
-    f"fio --direct=1 --ioengine=libaio --name=read-bomb "
-    f"--filename={dev} --readwrite=randread --iodepth={depth} --blocksize={size} "
-    f"--numjobs={jobs} --eta=always --eta-interval=1 | stdbuf -oL tr '\r' '\n'"
-)
-print(f'Running "{cmd}"', flush=True)
-
-subprocess.check_call(cmd, shell=True)
+
+# io_uring can be disabled by sysctl or missing from the fio build, fall
+# back to libaio in those cases.
+def io_uring_available():
+    try:
+        with open("/proc/sys/kernel/io_uring_disabled", "r") as f:
+            if int(f.read()):
+                return False
+    except FileNotFoundError:
+        pass
+    probe = subprocess.run(
+        ["fio", "--enghelp=io_uring"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return probe.returncode == 0
+
+
+if io_uring_available():
+    engine = ["--ioengine=io_uring", "--registerfiles", "--fixedbufs"]
+else:
+    engine = ["--ioengine=libaio"]
+
+batch = max(min(depth // 8, 16), 1)
+
+cmd = [
+    "fio",
+    "--direct=1",
+    *engine,
+    "--name=read-bomb",
+    f"--filename={dev}",
+    "--readwrite=randread",
+    "--norandommap",
+    f"--iodepth={depth}",
+    f"--iodepth_batch_submit={batch}",
+    "--iodepth_batch_complete_min=1",
+    f"--blocksize={size}",
+    f"--numjobs={jobs}",
+    "--eta=always",
+    "--eta-interval=1",
+]
+print(f'Running "{" ".join(cmd)}"', flush=True)
+
+# fio redraws the eta line with '\r', turn them into newlines for the log
+with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+    for buf in iter(lambda: proc.stdout.read1(65536), b""):
+        sys.stdout.buffer.write(buf.replace(b"\r", b"\n"))
+        sys.stdout.buffer.flush()
+
+if proc.returncode:
+    raise subprocess.CalledProcessError(proc.returncode, cmd)